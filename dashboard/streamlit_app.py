@@ -1,6 +1,7 @@
 import streamlit as st
 import requests
-import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 import time
 import socketio
 import json
@@ -9,44 +10,91 @@ import threading
 # Constants
 API_URL = "http://localhost:5001"
 SOCKET_URL = "http://localhost:5001"
-REFRESH_INTERVAL = 5  # seconds
+REFRESH_INTERVAL = 1  # seconds between checks for pushed updates
+ARROW_STREAM = 'application/vnd.apache.arrow.stream'
 
 # Initialize session state
 if 'data' not in st.session_state:
     st.session_state.data = None
 if 'last_update' not in st.session_state:
     st.session_state.last_update = None
-if 'connected' not in st.session_state:
-    st.session_state.connected = False
-
-# Setup SocketIO
-sio = socketio.Client()
-
-@sio.event
-def connect():
-    st.session_state.connected = True
-    print("Connected to server")
-
-@sio.event
-def disconnect():
-    st.session_state.connected = False
-    print("Disconnected from server")
-
-@sio.on('csv_update')
-def on_csv_update(data):
-    print("Received update via SocketIO")
-    st.session_state.data = data
-    st.session_state.last_update = time.time()
-    # Force Streamlit to refresh
-    st.rerun()
-
-# Connect to SocketIO server if not already connected
-def ensure_socket_connection():
-    if not st.session_state.connected:
-        try:
-            sio.connect(SOCKET_URL)
-        except Exception as e:
-            st.error(f"Failed to connect to server: {e}")
+if 'last_push' not in st.session_state:
+    st.session_state.last_push = None
+
+# Setup SocketIO once per session; reruns reuse the same connection.
+# Handlers run on the client's own thread, where st.session_state isn't
+# available, so they write into a plain dict the script reads instead.
+if 'sio' not in st.session_state:
+    socket_state = {'connected': False, 'data': None, 'last_update': None}
+    sio = socketio.Client()
+
+    @sio.event
+    def connect():
+        socket_state['connected'] = True
+        print("Connected to server")
+
+    @sio.event
+    def disconnect():
+        socket_state['connected'] = False
+        print("Disconnected from server")
+
+    @sio.on('csv_update')
+    def on_csv_update(data):
+        print("Received update via SocketIO")
+        socket_state['data'] = data
+        socket_state['last_update'] = time.time()
+
+    # Connect in the background; the client keeps retrying until the
+    # server is up and reconnects by itself after a drop
+    socket_thread = threading.Thread(target=sio.connect, args=(SOCKET_URL,), kwargs={'retry': True})
+    socket_thread.daemon = True
+    socket_thread.start()
+
+    st.session_state.sio = sio
+    st.session_state.socket_state = socket_state
+    st.session_state.socket_thread = socket_thread
+
+socket_state = st.session_state.socket_state
+
+# One HTTP session per browser session, so requests reuse a keep-alive connection
+if 'http' not in st.session_state:
+    st.session_state.http = requests.Session()
+http = st.session_state.http
+
+# Cached probes; reruns and other tabs within the TTL reuse the result
+@st.cache_data(ttl=5)
+def server_health(_http):
+    """Return the /health status code, or None if the server is unreachable"""
+    try:
+        return _http.get(f"{API_URL}/health", timeout=1).status_code
+    except requests.exceptions.RequestException:
+        return None
+
+@st.cache_data(ttl=2)
+def fetch_latest(_http):
+    """Return the most recently processed data, or None if there is none yet"""
+    # Ask for an Arrow stream so rows arrive columnar instead of as JSON dicts
+    response = _http.get(f"{API_URL}/data", headers={'Accept': ARROW_STREAM}, timeout=5, stream=True)
+    if response.status_code != 200:
+        return None
+    if response.headers.get('Content-Type') != ARROW_STREAM:
+        return response.json()
+    
+    table = pa.ipc.open_stream(response.raw).read_all()
+    data = json.loads(table.schema.metadata[b'envelope'])
+    data['data'] = table
+    return data
+
+def as_table(data):
+    """Return a copy of a result with its rows as an Arrow table"""
+    if 'data' in data and not isinstance(data['data'], pa.Table):
+        # Rows arrive as value lists in the order of data['columns']
+        table = pa.Table.from_arrays(
+            [pa.array(values, pa.string()) for values in zip(*data['data'])],
+            names=data['columns']
+        )
+        data = dict(data, data=table)
+    return data
 
 # Header
 st.title("CSV Data Dashboard")
@@ -60,7 +108,7 @@ if uploaded_file is not None:
         files = {'file': uploaded_file}
         with st.spinner("Uploading and processing..."):
             try:
-                response = requests.post(f"{API_URL}/upload", files=files)
+                response = http.post(f"{API_URL}/upload", files=files)
                 if response.status_code == 200:
                     result = response.json()
                     st.success(f"CSV uploaded for processing. Task ID: {result.get('task_id')}")
@@ -69,33 +117,12 @@ if uploaded_file is not None:
             except Exception as e:
                 st.error(f"Connection error: {e}")
 
-# Status indicators
-col1, col2 = st.columns(2)
-with col1:
-    # Check server health
-    try:
-        health_response = requests.get(f"{API_URL}/health")
-        if health_response.status_code == 200:
-            st.success("Server: Online")
-        else:
-            st.error("Server: Offline")
-    except:
-        st.error("Server: Offline")
-
-with col2:
-    if st.session_state.connected:
-        st.success("SocketIO: Connected")
-    else:
-        st.warning("SocketIO: Disconnected")
-        # Try to connect
-        ensure_socket_connection()
-
 # Manual refresh button
 if st.button("Refresh Data"):
     try:
-        response = requests.get(f"{API_URL}/data")
-        if response.status_code == 200:
-            st.session_state.data = response.json()
+        data = fetch_latest(http)
+        if data is not None:
+            st.session_state.data = as_table(data)
             st.session_state.last_update = time.time()
             st.success("Data refreshed")
         else:
@@ -103,56 +130,59 @@ if st.button("Refresh Data"):
     except Exception as e:
         st.error(f"Error fetching data: {e}")
 
-# Display last update time
-if st.session_state.last_update:
-    st.info(f"Last updated: {time.strftime('%H:%M:%S', time.localtime(st.session_state.last_update))}")
+# Only this panel reruns on the timer; it reads pushed updates from memory
+# and only probes the server (cached) while SocketIO is disconnected
+@st.fragment(run_every=REFRESH_INTERVAL)
+def data_panel():
+    # Status indicator, driven by SocketIO connect/disconnect events
+    if socket_state['connected']:
+        st.success("Server: Online (SocketIO connected)")
+    elif server_health(http) == 200:
+        st.warning("Server: Online, SocketIO reconnecting...")
+    else:
+        st.error("Server: Offline")
 
-# Display data
-if st.session_state.data and 'data' in st.session_state.data:
-    st.subheader("Processed CSV Data")
-    
-    # Show metadata
-    metadata = {
-        "Task ID": st.session_state.data.get("task_id", "N/A"),
-        "Rows": st.session_state.data.get("row_count", 0),
-        "Processed by": st.session_state.data.get("worker_id", "N/A"),
-        "Processing time": f"{st.session_state.data.get('processing_time', 0):.2f} seconds",
-        "Processed at": st.session_state.data.get("processed_at", "N/A")
-    }
-    
-    st.json(metadata)
-    
-    # Display as table
-    df = pd.DataFrame(st.session_state.data["data"])
-    st.dataframe(df)
-    
-    # Download option
-    csv = df.to_csv(index=False)
-    st.download_button(
-        "Download as CSV",
-        csv,
-        "processed_data.csv",
-        "text/csv",
-        key='download-csv'
-    )
-else:
-    st.info("No data available yet. Upload a CSV file or wait for processing to complete.")
-
-# Periodically check for updates (alternative to SocketIO)
-if not st.session_state.connected:
-    st.warning("Using polling for updates since SocketIO is not connected")
-    # Auto-refresh every few seconds using polling
-    time.sleep(1)  # Small delay
-    st.rerun()
-
-# Background SocketIO monitoring
-def socket_watcher():
-    while True:
-        if not st.session_state.connected:
-            ensure_socket_connection()
-        time.sleep(5)
-
-# Start socket watcher thread
-socket_thread = threading.Thread(target=socket_watcher)
-socket_thread.daemon = True
-socket_thread.start()
\ No newline at end of file
+    # Pick up the newest pushed update
+    if socket_state['last_update'] != st.session_state.last_push:
+        st.session_state.data = socket_state['data'] and as_table(socket_state['data'])
+        st.session_state.last_update = socket_state['last_update']
+        st.session_state.last_push = socket_state['last_update']
+
+    # Display last update time
+    if st.session_state.last_update:
+        st.info(f"Last updated: {time.strftime('%H:%M:%S', time.localtime(st.session_state.last_update))}")
+
+    # Display data
+    if st.session_state.data and 'data' in st.session_state.data:
+        st.subheader("Processed CSV Data")
+        
+        # Show metadata
+        metadata = {
+            "Task ID": st.session_state.data.get("task_id", "N/A"),
+            "Rows": st.session_state.data.get("row_count", 0),
+            "Processed by": st.session_state.data.get("worker_id", "N/A"),
+            "Processing time": f"{st.session_state.data.get('processing_time', 0):.2f} seconds",
+            "Processed at": st.session_state.data.get("processed_at", "N/A")
+        }
+        
+        st.json(metadata)
+        
+        # Display as table; st.dataframe takes Arrow tables as-is
+        table = st.session_state.data["data"]
+        st.dataframe(table)
+        
+        # Download option
+        buffer = pa.BufferOutputStream()
+        pa_csv.write_csv(table, buffer)
+        csv = buffer.getvalue().to_pybytes()
+        st.download_button(
+            "Download as CSV",
+            csv,
+            "processed_data.csv",
+            "text/csv",
+            key='download-csv'
+        )
+    else:
+        st.info("No data available yet. Upload a CSV file or wait for processing to complete.")
+
+data_panel()
\ No newline at end of file
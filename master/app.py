@@ -1,20 +1,33 @@
+import eventlet
+eventlet.monkey_patch()
+
 from flask import Flask, jsonify, request
 from flask_socketio import SocketIO
 import threading
 import json
+import uuid
+import orjson
+import pyarrow as pa
+from pybloom_live import ScalableBloomFilter
 from rabbitmq_handler import RabbitMQHandler
-from csv_processor import process_csv, generate_task_id
 
 app = Flask(__name__)
-socketio = SocketIO(app, cors_allowed_origins="*")
+socketio = SocketIO(app, async_mode='eventlet', cors_allowed_origins="*")
 
 # Shared state for most recent data
 latest_data = None
-processed_tasks = set()  # For deduplication
+latest_data_lock = threading.Lock()
+latest_data_dirty = False  # Set when latest_data hasn't been broadcast yet
+latest_arrow = None  # latest_data as an Arrow stream, built on first request
+BROADCAST_INTERVAL = 0.05  # seconds
+
+# For deduplication: ~10 bits per task and no eviction; at 0.1% a new
+# result may rarely be mistaken for a duplicate and skipped
+processed_tasks = ScalableBloomFilter(initial_capacity=100_000, error_rate=0.001)
 
 def handle_processed_result(data):
     """Handle processed results from workers"""
-    global latest_data
+    global latest_data, latest_data_dirty, latest_arrow
     
     # Deduplication check
     task_id = data.get('task_id')
@@ -23,33 +36,76 @@ def handle_processed_result(data):
         return
     
     processed_tasks.add(task_id)
-    # Limit size of processed_tasks set
-    if len(processed_tasks) > 1000:
-        processed_tasks.pop()
-    
-    # Update latest data
-    latest_data = data
     
-    # Emit SocketIO event
-    socketio.emit('csv_update', data)
+    # Update latest data; the broadcaster emits it on its next tick
+    with latest_data_lock:
+        latest_data = data
+        latest_data_dirty = True
+        latest_arrow = None
+
+def broadcast_updates():
+    """Broadcast the newest result at most once per BROADCAST_INTERVAL"""
+    # Bursts of results collapse into one emit, so the payload is
+    # serialized once per tick rather than once per result
+    global latest_data_dirty
+    while True:
+        socketio.sleep(BROADCAST_INTERVAL)
+        with latest_data_lock:
+            if not latest_data_dirty:
+                continue
+            data = latest_data
+            latest_data_dirty = False
+        socketio.emit('csv_update', data)
 
 # Initialize RabbitMQ handler
 rabbit_handler = RabbitMQHandler(callback=handle_processed_result)
 
-# Start RabbitMQ consumer in a separate thread
+# Start RabbitMQ consumer in a green thread; with sockets monkey-patched
+# the blocking consumer yields to the event loop while it waits
 def start_rabbitmq_consumer():
     rabbit_handler.start_consuming()
 
-consumer_thread = threading.Thread(target=start_rabbitmq_consumer)
-consumer_thread.daemon = True
-consumer_thread.start()
+socketio.start_background_task(start_rabbitmq_consumer)
+
+socketio.start_background_task(broadcast_updates)
+
+ARROW_STREAM = 'application/vnd.apache.arrow.stream'
+
+def ojson(data):
+    """Build a JSON response with orjson rather than stdlib json"""
+    return app.response_class(orjson.dumps(data), mimetype='application/json')
+
+def to_arrow_stream(data):
+    """Serialize a processed result as an Arrow IPC stream"""
+    # Rows become columns; the rest of the result rides in the schema metadata
+    table = pa.Table.from_arrays(
+        [pa.array(values, pa.string()) for values in zip(*data['data'])],
+        names=data['columns']
+    )
+    envelope = {key: value for key, value in data.items() if key != 'data'}
+    table = table.replace_schema_metadata({'envelope': json.dumps(envelope)})
+    
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
 
 @app.route('/data', methods=['GET'])
 def get_data():
     """Return the most recently processed CSV data"""
+    global latest_arrow
     if latest_data is None:
         return jsonify({"error": "No data available yet"}), 404
-    return jsonify(latest_data)
+    
+    # Columnar Arrow for clients that ask for it, JSON otherwise
+    wants_arrow = request.accept_mimetypes.best_match(['application/json', ARROW_STREAM]) == ARROW_STREAM
+    if wants_arrow and 'data' in latest_data:
+        with latest_data_lock:
+            if latest_arrow is None:
+                latest_arrow = to_arrow_stream(latest_data)
+            body = latest_arrow
+        return app.response_class(body, mimetype=ARROW_STREAM)
+    return ojson(latest_data)
 
 @app.route('/upload', methods=['POST'])
 def upload_csv():
@@ -62,14 +118,15 @@ def upload_csv():
         return jsonify({"error": "No file selected"}), 400
     
     try:
-        # Read CSV content
-        csv_content = file.read().decode('utf-8')
-        
-        # Generate task ID
-        task_id = generate_task_id(csv_content)
+        # Read CSV content, kept as bytes end to end
+        csv_bytes = file.read()
+
+        # Issue the task ID without touching the payload, so the request
+        # returns at once for any upload size; workers hash the content
+        task_id = uuid.uuid4().hex
         
         # Publish to RabbitMQ
-        rabbit_handler.publish_task(csv_content, task_id)
+        rabbit_handler.publish_task(csv_bytes, task_id)
         
         return jsonify({
             "status": "success", 
@@ -103,4 +160,5 @@ def handle_update_request(data):
         socketio.emit('csv_update', latest_data, to=request.sid)
 
 if __name__ == '__main__':
-    socketio.run(app, debug=True, host='0.0.0.0', port=5001)
\ No newline at end of file
+    # Development server; use wsgi.py under gunicorn in production
+    socketio.run(app, host='0.0.0.0', port=5001)
\ No newline at end of file
@@ -1,8 +1,14 @@
 import pika
-import json
+import orjson
 from csv_processor import process_csv
 
 class RabbitMQHandler:
+    PREFETCH_COUNT = 64
+    # Results are acknowledged together once this many are pending, or
+    # after ACK_INTERVAL seconds, whichever comes first
+    ACK_BATCH_SIZE = 32
+    ACK_INTERVAL = 0.1
+    
     def __init__(self, callback, host='localhost'):
         self.callback = callback
         self.connection = pika.BlockingConnection(pika.ConnectionParameters(host=host))
@@ -12,6 +18,11 @@ class RabbitMQHandler:
         self.channel.queue_declare(queue='csv_tasks')
         self.channel.queue_declare(queue='processed_results')
         
+        # Let the broker keep a window of results in flight
+        self.channel.basic_qos(prefetch_count=self.PREFETCH_COUNT)
+        self._last_unacked_tag = None
+        self._unacked_count = 0
+        
         # Set up consumer
         self.channel.basic_consume(
             queue='processed_results',
@@ -21,27 +32,56 @@ class RabbitMQHandler:
     
     def on_message(self, ch, method, properties, body):
         try:
-            data = json.loads(body)
-            self.callback(data)
-            ch.basic_ack(delivery_tag=method.delivery_tag)
+            payload = orjson.loads(body)
+        except orjson.JSONDecodeError as e:
+            # Redelivery can't fix a body that isn't JSON, so drop it
+            print(f"Discarding malformed message: {e}")
+            self._flush_acks()
+            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+            return
+        
+        try:
+            # Workers publish their results in batches of one or more;
+            # older workers publish one bare result per message
+            results = payload['results'] if 'results' in payload else [payload]
+            for result in results:
+                self.callback(result)
         except Exception as e:
             print(f"Error processing message: {e}")
-            # Negative acknowledgment with requeue set to True
+            # Settle earlier messages first so a later multiple ack
+            # can't cover this one, then negative acknowledgment with requeue
+            self._flush_acks()
             ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+            return
+        
+        self._last_unacked_tag = method.delivery_tag
+        self._unacked_count += 1
+        if self._unacked_count >= self.ACK_BATCH_SIZE:
+            self._flush_acks()
+        elif self._unacked_count == 1:
+            self.connection.call_later(self.ACK_INTERVAL, self._flush_acks)
+    
+    def _flush_acks(self):
+        """Acknowledge all pending results with a single multiple ack"""
+        if self._last_unacked_tag is None:
+            return
+        self.channel.basic_ack(delivery_tag=self._last_unacked_tag, multiple=True)
+        self._last_unacked_tag = None
+        self._unacked_count = 0
     
-    def publish_task(self, csv_data, task_id):
+    def publish_task(self, csv_bytes, task_id):
         """Publish CSV task to workers"""
-        message = {
-            'task_id': task_id,
-            'csv_data': csv_data
-        }
+        # The CSV is the message body as-is; the task ID travels as the
+        # message ID, so there is no serialization wrapper at all
         self.channel.basic_publish(
             exchange='',
             routing_key='csv_tasks',
-            body=json.dumps(message),
+            body=csv_bytes,
             properties=pika.BasicProperties(
                 delivery_mode=2,  # Make message persistent
-                message_id=task_id  # For deduplication
+                message_id=task_id,  # Task ID, also used for deduplication
+                content_type='text/csv',
+                headers={'task_id': task_id}
             )
         )
     
@@ -52,4 +92,5 @@ class RabbitMQHandler:
     def stop_consuming(self):
         """Stop consuming messages and close connection"""
         self.channel.stop_consuming()
+        self._flush_acks()
         self.connection.close()
\ No newline at end of file
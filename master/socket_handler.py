@@ -1,14 +1,24 @@
 from flask_socketio import SocketIO, emit
 import threading
-import queue
-import time
+from collections import deque
 
 class SocketHandler:
+    # Maximum number of queued messages emitted per wakeup
+    MAX_BATCH = 64
+    # Client messages beyond this are dropped, oldest first
+    MAX_QUEUE_SIZE = 256
+    
     def __init__(self, app, cors_allowed_origins="*"):
         """Initialize the socket handler with Flask app"""
         self.socketio = SocketIO(app, cors_allowed_origins=cors_allowed_origins)
         self.clients = set()
-        self.message_queue = queue.Queue()
+        # Messages for specific clients, bounded so a slow emitter can't
+        # grow memory without limit
+        self.message_queue = deque(maxlen=self.MAX_QUEUE_SIZE)
+        # Newest unsent payload per broadcast event; latest value wins, so
+        # superseded snapshots are never delivered
+        self.latest_broadcasts = {}
+        self.pending = threading.Condition()
         
         # Set up event handlers
         self.register_handlers()
@@ -44,35 +54,41 @@ class SocketHandler:
             self.socketio.emit('request_acknowledged', {'status': 'processing'}, to=client_id)
     
     def emit_update(self, event_name, data):
-        """Add update to the queue for broadcasting to all clients"""
-        self.message_queue.put((event_name, data))
+        """Schedule an update for broadcasting to all clients"""
+        with self.pending:
+            self.latest_broadcasts[event_name] = data
+            self.pending.notify()
     
     def emit_to_client(self, client_id, event_name, data):
         """Add update to the queue for a specific client"""
-        self.message_queue.put((event_name, data, client_id))
+        with self.pending:
+            self.message_queue.append((event_name, data, client_id))
+            self.pending.notify()
     
     def _process_queue(self):
         """Background thread to process the message queue"""
         while True:
-            try:
-                if not self.message_queue.empty():
-                    message = self.message_queue.get()
-                    
-                    if len(message) == 3:
+            # Block until there is work, then take everything pending so a
+            # burst is emitted in a single wakeup
+            with self.pending:
+                while not self.latest_broadcasts and not self.message_queue:
+                    self.pending.wait()
+                broadcasts = self.latest_broadcasts
+                self.latest_broadcasts = {}
+                batch = [self.message_queue.popleft()
+                         for _ in range(min(len(self.message_queue), self.MAX_BATCH))]
+            
+            messages = [(event_name, data, None) for event_name, data in broadcasts.items()]
+            for event_name, data, client_id in messages + batch:
+                try:
+                    if client_id is not None:
                         # Message for specific client
-                        event_name, data, client_id = message
                         self.socketio.emit(event_name, data, to=client_id)
                     else:
                         # Broadcast message
-                        event_name, data = message
                         self.socketio.emit(event_name, data)
-                    
-                    self.message_queue.task_done()
-                
-                # Sleep to prevent CPU hogging
-                time.sleep(0.01)
-            except Exception as e:
-                print(f"Error in socket message processing: {e}")
+                except Exception as e:
+                    print(f"Error in socket message processing: {e}")
     
     def get_socketio(self):
         """Return the SocketIO instance"""
@@ -84,10 +100,7 @@ class SocketHandler:
     
     def shutdown(self):
         """Cleanup resources"""
-        # Clear message queue
-        while not self.message_queue.empty():
-            self.message_queue.get()
-            self.message_queue.task_done()
-        
-        # Wait for queue to process
-        self.message_queue.join()
\ No newline at end of file
+        # Drop anything not yet emitted
+        with self.pending:
+            self.message_queue.clear()
+            self.latest_broadcasts.clear()
\ No newline at end of file
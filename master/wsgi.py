@@ -0,0 +1,5 @@
+# WSGI entry point for production; run from the master directory with:
+#   gunicorn -k eventlet -w 1 -b 0.0.0.0:5001 --keep-alive 30 wsgi:app
+# Keep a single worker: SocketIO clients and the in-memory latest result
+# must all live in one process.
+from app import app, socketio
\ No newline at end of file
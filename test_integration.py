@@ -12,15 +12,55 @@ import pandas as pd
 import tempfile
 import sys
 from pathlib import Path
+from unittest import mock
 
 # Add project root to path for importing modules
 sys.path.insert(0, str(Path(__file__).parent))
 
 # Import modules from project
-from master.csv_processor import process_csv, generate_task_id
+from master.csv_processor import process_csv, content_hash
 from master.rabbitmq_handler import RabbitMQHandler
 from worker.worker import Worker
 
+class _RecordingChannel:
+    """Channel stand-in that records what a Worker publishes and acknowledges"""
+    def __init__(self):
+        self.published = []
+        self.acks = []
+        self.nacks = []
+    
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.published.append(body)
+    
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.acks.append((delivery_tag, multiple))
+    
+    def basic_nack(self, delivery_tag, requeue=True):
+        self.nacks.append(delivery_tag)
+    
+    def __getattr__(self, name):
+        # Declarations, QoS and consumer setup need no broker here
+        return lambda *args, **kwargs: None
+
+class _ManualConnection:
+    """Connection stand-in whose scheduled callbacks run only when asked"""
+    def __init__(self):
+        self.chan = _RecordingChannel()
+        self.callbacks = []
+    
+    def channel(self):
+        return self.chan
+    
+    def call_later(self, delay, callback):
+        self.callbacks.append(callback)
+    
+    def add_callback_threadsafe(self, callback):
+        self.callbacks.append(callback)
+    
+    def run_callbacks(self):
+        while self.callbacks:
+            self.callbacks.pop(0)()
+
 class DistributedCSVProcessorTest(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -38,6 +78,8 @@ class DistributedCSVProcessorTest(unittest.TestCase):
         
         # Setup SocketIO for receiving updates
         cls.received_updates = []
+        cls._by_task = {}  # task_id -> its latest update
+        cls._events = {}  # task_id -> Event set when its update arrives
         cls.sio = socketio.Client()
         
         @cls.sio.event
@@ -48,6 +90,8 @@ class DistributedCSVProcessorTest(unittest.TestCase):
         def on_csv_update(data):
             print("Received update via SocketIO")
             cls.received_updates.append(data)
+            cls._by_task[data.get('task_id')] = data
+            cls._task_event(data.get('task_id')).set()
         
         # Connect to SocketIO
         try:
@@ -62,6 +106,10 @@ class DistributedCSVProcessorTest(unittest.TestCase):
         if cls.sio.connected:
             cls.sio.disconnect()
         
+        # Close the shared AMQP connection
+        if cls.pika_conn and cls.pika_conn.is_open:
+            cls.pika_conn.close()
+        
         # Clean up test file
         if os.path.exists(cls.test_csv_path):
             os.remove(cls.test_csv_path)
@@ -74,6 +122,13 @@ class DistributedCSVProcessorTest(unittest.TestCase):
             f.write(cls.test_csv_content)
         return path
     
+    @classmethod
+    def _task_event(cls, task_id):
+        """Return the Event for a task, creating it on first use"""
+        # Whichever of the upload and the update comes first creates it, so
+        # an update arriving before the upload response isn't missed
+        return cls._events.setdefault(task_id, threading.Event())
+    
     @classmethod
     def _check_services_running(cls):
         """Verify all required services are running"""
@@ -85,11 +140,15 @@ class DistributedCSVProcessorTest(unittest.TestCase):
         except requests.exceptions.ConnectionError:
             print("Warning: Master server is not running")
         
-        # Check RabbitMQ
+        # Check RabbitMQ, keeping the connection and a channel with publisher
+        # confirms open for the tests to share
         try:
-            connection = pika.BlockingConnection(pika.ConnectionParameters('localhost'))
-            connection.close()
+            cls.pika_conn = pika.BlockingConnection(pika.ConnectionParameters('localhost'))
+            cls.pika_chan = cls.pika_conn.channel()
+            cls.pika_chan.confirm_delivery()
         except Exception:
+            cls.pika_conn = None
+            cls.pika_chan = None
             print("Warning: RabbitMQ server is not running")
     
     def test_01_csv_processor(self):
@@ -105,32 +164,35 @@ class DistributedCSVProcessorTest(unittest.TestCase):
         self.assertIn('data', result)
         
         # Check data content
+        self.assertEqual(result['columns'], ['name', 'value', 'category'])
         data = result['data']
         self.assertEqual(len(data), 3)
-        self.assertEqual(data[0]['name'], 'item1')
-        self.assertEqual(data[1]['value'], '20')
-        self.assertEqual(data[2]['category'], 'C')
+        self.assertEqual(list(data[0]), ['item1', '10', 'A'])
+        self.assertEqual(data[1][1], '20')
+        self.assertEqual(data[2][2], 'C')
     
-    def test_02_task_id_generation(self):
-        """Test task ID generation"""
-        # Generate task IDs
-        task_id1 = generate_task_id(self.test_csv_content)
-        task_id2 = generate_task_id(self.test_csv_content)
-        task_id3 = generate_task_id("different,content\n1,2")
-        
-        # Task IDs for the same content should have the same hash prefix
-        self.assertTrue(task_id1.split('_')[0] == task_id2.split('_')[0])
-        
-        # Task IDs for different content should have different hash prefixes
-        self.assertFalse(task_id1.split('_')[0] == task_id3.split('_')[0])
+    def test_02_content_hash(self):
+        """Test content hashing"""
+        # Hash the same content twice, once as the bytes workers receive
+        hash1 = content_hash(self.test_csv_content)
+        hash2 = content_hash(self.test_csv_content.encode())
+        hash3 = content_hash("different,content\n1,2")
+        
+        # The same content should have the same hash
+        self.assertEqual(hash1, hash2)
+        
+        # Different content should have different hashes
+        self.assertNotEqual(hash1, hash3)
     
     def test_03_rabbitmq_handler(self):
         """Test RabbitMQ handler functionality"""
         # Create a test callback function
         callback_data = []
+        received = threading.Event()
         
         def test_callback(data):
             callback_data.append(data)
+            received.set()
         
         # Initialize RabbitMQ handler
         handler = RabbitMQHandler(callback=test_callback)
@@ -139,7 +201,7 @@ class DistributedCSVProcessorTest(unittest.TestCase):
         task_id = f"test_{int(time.time())}"
         
         # Publish a test task
-        handler.publish_task(self.test_csv_content, task_id)
+        handler.publish_task(self.test_csv_content.encode(), task_id)
         
         # Start consuming in a separate thread
         consumer_thread = threading.Thread(target=handler.start_consuming)
@@ -147,10 +209,7 @@ class DistributedCSVProcessorTest(unittest.TestCase):
         consumer_thread.start()
         
         # Wait for processing
-        timeout = 10
-        start_time = time.time()
-        while not callback_data and time.time() - start_time < timeout:
-            time.sleep(0.5)
+        received.wait(timeout=10)
         
         # Stop consuming
         handler.stop_consuming()
@@ -160,55 +219,49 @@ class DistributedCSVProcessorTest(unittest.TestCase):
     
     def test_04_worker_functionality(self):
         """Test worker node functionality"""
-        # Initialize a worker in a separate thread
+        # Initialize a worker on the shared connection; its consumer runs
+        # whenever the test services the connection, so no thread is needed
         worker_id = f"test-worker-{int(time.time())}"
-        worker = Worker(worker_id=worker_id)
+        worker = Worker(worker_id=worker_id, connection=self.pika_conn)
         
         # Mock a task message
         task_id = f"test_task_{int(time.time())}"
-        message = {
-            'task_id': task_id,
-            'csv_data': self.test_csv_content
-        }
-        
-        # Create a channel for publishing
-        connection = pika.BlockingConnection(pika.ConnectionParameters('localhost'))
-        channel = connection.channel()
+        channel = self.pika_chan
         
         # Publish a test task
         channel.basic_publish(
             exchange='',
             routing_key='csv_tasks',
-            body=json.dumps(message),
+            body=self.test_csv_content.encode(),
             properties=pika.BasicProperties(
                 delivery_mode=2,
-                message_id=task_id
+                message_id=task_id,
+                content_type='text/csv',
+                headers={'task_id': task_id}
             )
         )
         
-        # Start worker in a separate thread
-        worker_thread = threading.Thread(target=worker.start)
-        worker_thread.daemon = True
-        worker_thread.start()
-        
-        # Wait for processing
-        time.sleep(3)
-        
-        # Check if a result was published
+        # Check for a published result until it arrives or we time out,
+        # servicing the connection (and so the worker) between polls
         channel.queue_declare(queue='processed_results')
+        deadline = time.time() + 10
         method_frame, header_frame, body = channel.basic_get(queue='processed_results')
+        while method_frame is None and time.time() < deadline:
+            self.pika_conn.process_data_events(time_limit=0.05)
+            method_frame, header_frame, body = channel.basic_get(queue='processed_results')
         
         # Cleanup
         if method_frame:
             channel.basic_ack(method_frame.delivery_tag)
-        connection.close()
+        # Stop the test worker so later tasks go to the running workers
+        worker.channel.close()
         
         # Verify we got a result
         self.assertIsNotNone(method_frame, "No result was published by the worker")
         
-        # Parse and verify result
+        # Parse and verify result; results arrive in batches
         if body:
-            result = json.loads(body)
+            result = json.loads(body)['results'][0]
             self.assertEqual(result['worker_id'], worker_id)
             self.assertEqual(result['task_id'], task_id)
             self.assertEqual(result['row_count'], 3)
@@ -230,8 +283,8 @@ class DistributedCSVProcessorTest(unittest.TestCase):
         self.assertEqual(upload_result['status'], 'success')
         self.assertIn('task_id', upload_result)
         
-        # Wait for processing
-        time.sleep(3)
+        # Wait for processing; the result is pushed over SocketIO
+        self._task_event(upload_result['task_id']).wait(timeout=15)
         
         # Test data retrieval
         data_response = requests.get(f"{self.API_URL}/data")
@@ -249,13 +302,10 @@ class DistributedCSVProcessorTest(unittest.TestCase):
         # Upload a new file to trigger updates
         with open(self.test_csv_path, 'rb') as f:
             files = {'file': f}
-            requests.post(f"{self.API_URL}/upload", files=files)
+            upload_response = requests.post(f"{self.API_URL}/upload", files=files)
         
         # Wait for SocketIO update
-        timeout = 10
-        start_time = time.time()
-        while not self.received_updates and time.time() - start_time < timeout:
-            time.sleep(0.5)
+        self._task_event(upload_response.json()['task_id']).wait(timeout=15)
         
         # Verify we received an update
         self.assertTrue(len(self.received_updates) > 0, "No SocketIO updates received")
@@ -285,34 +335,21 @@ class DistributedCSVProcessorTest(unittest.TestCase):
         # Get the task ID
         task_id = upload_response.json()['task_id']
         
-        # 3. Wait for processing
-        timeout = 15
-        start_time = time.time()
+        # 3. Wait for processing; only this task's csv_update wakes the wait
         processed_data = None
-        
-        while time.time() - start_time < timeout:
-            # Check for SocketIO updates
-            if self.received_updates:
-                for update in self.received_updates:
-                    if update.get('task_id') == task_id:
-                        processed_data = update
-                        break
-            
-            # If no SocketIO update, try the API
-            if not processed_data:
-                try:
-                    response = requests.get(f"{self.API_URL}/data")
-                    if response.status_code == 200:
-                        data = response.json()
-                        if data.get('task_id') == task_id:
-                            processed_data = data
-                except:
-                    pass
-            
-            if processed_data:
-                break
-                
-            time.sleep(1)
+        if self._task_event(task_id).wait(timeout=15):
+            processed_data = self._by_task[task_id]
+        
+        # If no SocketIO update arrived, try the API once
+        if not processed_data:
+            try:
+                response = requests.get(f"{self.API_URL}/data")
+                if response.status_code == 200:
+                    data = response.json()
+                    if data.get('task_id') == task_id:
+                        processed_data = data
+            except:
+                pass
         
         # Clean up
         os.remove(unique_path)
@@ -322,10 +359,77 @@ class DistributedCSVProcessorTest(unittest.TestCase):
         
         # 5. Check content
         self.assertEqual(processed_data['row_count'], 1)
-        self.assertEqual(processed_data['data'][0]['name'], 'test')
-        self.assertEqual(processed_data['data'][0]['value'], '123')
+        columns = processed_data['columns']
+        self.assertEqual(processed_data['data'][0][columns.index('name')], 'test')
+        self.assertEqual(processed_data['data'][0][columns.index('value')], '123')
         self.assertIn('worker_id', processed_data)
         self.assertIn('processing_time', processed_data)
+    
+    def test_08_worker_skips_duplicate_in_flight(self):
+        """Test a task redelivered while still processing is skipped"""
+        conn = _ManualConnection()
+        worker = Worker(worker_id="test-worker-dedup", connection=conn)
+        properties = pika.BasicProperties(message_id='dup')
+        body = self.test_csv_content.encode()
+        
+        # The copy arrives before the first delivery's result is handled
+        worker.process_task(conn.chan, pika.spec.Basic.Deliver(delivery_tag=1), properties, body)
+        worker.process_task(conn.chan, pika.spec.Basic.Deliver(delivery_tag=2), properties, body)
+        
+        # While task 1 runs, the skipped copy is acknowledged on its own;
+        # a multiple ack here would also cover the running task
+        worker._flush_results()
+        self.assertEqual(conn.chan.acks, [(2, False)])
+        
+        worker._pool.shutdown(wait=True)
+        conn.run_callbacks()
+        worker._flush_results()
+        
+        # One result is published, and task 1 is acknowledged once done
+        results = [result for batch in conn.chan.published for result in json.loads(batch)['results']]
+        self.assertEqual([result['task_id'] for result in results], ['dup'])
+        self.assertTrue(any(tag == 1 or (multiple and tag >= 1) for tag, multiple in conn.chan.acks[1:]),
+                        f"Task 1 was never acknowledged: {conn.chan.acks}")
+        self.assertEqual(conn.chan.nacks, [])
+    
+    def test_09_csv_size_threshold(self):
+        """Test CSVs either side of the small-file cutover parse alike"""
+        from master.csv_processor import SMALL_CSV_ROWS
+        
+        # The cutover counts newlines: at the limit the file is parsed in
+        # Python, one line more and it goes to Arrow
+        for line_count in (SMALL_CSV_ROWS, SMALL_CSV_ROWS + 1):
+            rows = [(f"item{i}", str(i)) for i in range(line_count - 1)]
+            content = "name,value\n" + "".join(f"{name},{value}\n" for name, value in rows)
+            result = process_csv(content)
+            
+            self.assertEqual(result['status'], 'success')
+            self.assertEqual(result['row_count'], len(rows))
+            self.assertEqual(result['columns'], ['name', 'value'])
+            self.assertEqual(result['data'], rows)
+    
+    def test_10_csv_parse_paths_agree(self):
+        """Test every CSV parsing path returns the same rows and errors"""
+        def parse_each_way(content):
+            # Unquoted input is split by the generated parser, CRLF or
+            # quoted input by csv.reader, and anything over the cutover
+            # by Arrow
+            variants = [content, content.replace('\n', '\r\n'), content.replace('item1', '"item1"')]
+            results = [process_csv(variant) for variant in variants]
+            with mock.patch('master.csv_processor.SMALL_CSV_ROWS', -1):
+                results.append(process_csv(content))
+            return results
+        
+        expected = [('item1', '10', 'A'), ('item2', '', 'B'), ('item3', '30', 'C')]
+        for result in parse_each_way("name,value,category\nitem1,10,A\nitem2,,B\nitem3,30,C\n"):
+            self.assertEqual(result['status'], 'success')
+            self.assertEqual(result['columns'], ['name', 'value', 'category'])
+            self.assertEqual(result['data'], expected)
+        
+        # Ragged rows fall back to Arrow, which reports the error
+        errors = [result.get('error') for result in parse_each_way("name,value\nitem1,10\nitem2,20,B\n")]
+        self.assertIsNotNone(errors[0])
+        self.assertEqual(errors, [errors[-1]] * len(errors))
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
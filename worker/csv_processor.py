@@ -1,47 +1,136 @@
 import csv
-import io
 import json
-import hashlib
-import time
+import io
+import os
 from datetime import datetime
+from functools import lru_cache
+
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import xxhash
+
+# Columns every CSV must have (example); adjust based on your CSV structure
+REQUIRED_COLUMNS = frozenset({"name", "value"})
+
+# Block-size heuristic for Arrow, which parses blocks concurrently on
+# its own CPU pool: aim for this many blocks per file (parallel gains
+# flatten beyond ~6), keeping each block between 1 MB and 10 MB, so
+# files over 60 MB get more blocks
+TARGET_PARSE_BLOCKS = min(6, os.cpu_count() or 1)
+MIN_BLOCK_SIZE = 1 << 20
+MAX_BLOCK_SIZE = 10 << 20
+
+# Up to about this many rows plain Python parsing beats Arrow, whose
+# fixed per-call setup dominates small files
+SMALL_CSV_ROWS = 1000
 
 def process_csv(csv_data, task_id=None):
     """Process CSV data and return structured data"""
     try:
-        # Parse CSV data
-        csv_file = io.StringIO(csv_data)
-        reader = csv.DictReader(csv_file)
+        if isinstance(csv_data, str):
+            csv_data = csv_data.encode()
+        columns = _read_header(csv_data)
+        if not columns:
+            return {"error": "Empty CSV data", "task_id": task_id}
         
-        # Convert to list of dictionaries
-        data = list(reader)
+        # Small CSVs are read with the csv module; anything larger, or any
+        # small file it can't map onto the header, goes to Arrow
+        data = None
+        if csv_data.count(b'\n') <= SMALL_CSV_ROWS:
+            data = _read_small(csv_data, len(columns))
+        if data is None:
+            # Parse CSV data into an Arrow table with pyarrow's multithreaded
+            # C++ reader, keeping every value as a string
+            table = pa_csv.read_csv(
+                pa.BufferReader(csv_data),
+                read_options=_read_options(len(csv_data)),
+                convert_options=pa_csv.ConvertOptions(column_types={col: pa.string() for col in columns})
+            )
         
         # Basic validation
-        if not data:
+        if (table.num_rows if data is None else len(data)) == 0:
             return {"error": "Empty CSV data", "task_id": task_id}
         
-        # Check for required columns (example)
-        required_columns = ["name", "value"]  # Adjust based on your CSV structure
-        for col in required_columns:
-            if col not in data[0]:
-                return {"error": f"Missing required column: {col}", "task_id": task_id}
+        # Check for required columns in a single set operation
+        missing = REQUIRED_COLUMNS.difference(columns)
+        if missing:
+            return {"error": f"Missing required columns: {', '.join(sorted(missing))}", "task_id": task_id}
+        
+        # Rows are plain value sequences in header order; column names
+        # are sent once alongside them rather than repeated in every row
+        if data is None:
+            data = list(zip(*(column.to_pylist() for column in table.columns)))
         
-        # Data enrichment (example)
-        for row in data:
-            row['processed_at'] = datetime.now().isoformat()
+        # Every row shares one processing timestamp, so it lives on the
+        # envelope only rather than being stamped onto each row
+        processed_at = datetime.now().isoformat()
             
         # Return processed data
         return {
             "status": "success",
             "task_id": task_id,
             "row_count": len(data),
+            "columns": columns,
             "data": data,
-            "processed_at": datetime.now().isoformat()
+            "processed_at": processed_at
         }
     except Exception as e:
         return {"error": str(e), "task_id": task_id}
 
-def generate_task_id(csv_data):
-    """Generate a unique task ID based on content and timestamp"""
-    content_hash = hashlib.md5(csv_data.encode()).hexdigest()
-    timestamp = int(time.time())
-    return f"{content_hash}_{timestamp}"
\ No newline at end of file
+def _read_small(csv_data, width):
+    """Return the data rows of a small CSV, or None if they don't fit the header"""
+    # Like the Arrow reader, skip a UTF-8 BOM and blank lines
+    text = csv_data.decode('utf-8-sig')
+    if '"' not in text and '\r' not in text:
+        # Without quoting every line is just its fields joined by commas
+        try:
+            return _split_parser(width)(text.split('\n'))
+        except ValueError:
+            return None
+    rows = [tuple(row) for row in csv.reader(io.StringIO(text)) if row]
+    # Ragged rows are left for Arrow to report
+    if any(len(row) != width for row in rows):
+        return None
+    return rows[1:]
+
+@lru_cache(maxsize=32)
+def _split_parser(width):
+    """Build a parser for unquoted CSV lines with exactly width fields"""
+    # Unpacking into one local per column checks the field count and
+    # builds each row without a per-row length test or list copy
+    fields = ', '.join(f'c{i}' for i in range(width))
+    source = (
+        "def parse(lines):\n"
+        "    rows = []\n"
+        "    append = rows.append\n"
+        "    for line in lines:\n"
+        "        if line:\n"
+        f"            {fields}, = line.split(',')\n"
+        f"            append(({fields},))\n"
+        "    return rows[1:]\n"
+    )
+    namespace = {}
+    exec(source, namespace)
+    return namespace['parse']
+
+def _read_options(size):
+    """Return Arrow read options with a block size suited to size bytes"""
+    # Arrow cuts blocks on row boundaries; this only sizes them, and the
+    # number of threads parsing them is up to Arrow's pool
+    block_size = min(MAX_BLOCK_SIZE, max(MIN_BLOCK_SIZE, size // TARGET_PARSE_BLOCKS + 1))
+    return pa_csv.ReadOptions(use_threads=True, block_size=block_size)
+
+def _read_header(csv_data):
+    """Return the column names from the first line of the CSV bytes"""
+    # Like the Arrow reader, skip a UTF-8 BOM and leading blank lines
+    first_line = csv_data.lstrip(b'\r\n').split(b'\n', 1)[0].decode('utf-8-sig')
+    return next(csv.reader([first_line]), [])
+
+def content_hash(csv_data):
+    """Return a hash identifying the CSV content"""
+    # Hash raw bytes directly so uploads aren't decoded and re-encoded;
+    # XXH3 runs at memory bandwidth but is not collision resistant, so a
+    # matching digest alone must not be taken as matching content
+    if isinstance(csv_data, str):
+        csv_data = csv_data.encode()
+    return xxhash.xxh3_64_hexdigest(csv_data)
\ No newline at end of file
@@ -1,23 +1,79 @@
 import pika
-import json
+try:
+    # orjson encodes straight to bytes, which pika publishes as-is
+    import orjson as json
+except ImportError:
+    import json
 import sys
 import time
 import os
 import random
-from csv_processor import process_csv
+import queue
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from csv_processor import process_csv, content_hash
 
 class Worker:
-    def __init__(self, worker_id, host='localhost'):
+    # Threads processing CSVs: one per core less the one driving the
+    # connection, capped to limit contention
+    MAX_THREADS = min(16, max(1, (os.cpu_count() or 2) - 1))
+    # Enough deliveries to fill a result batch and keep every thread busy
+    PREFETCH_COUNT = max(32, MAX_THREADS * 2)
+    # Finished results are published together once this many are pending,
+    # or after FLUSH_INTERVAL seconds, whichever comes first
+    RESULT_BATCH_SIZE = 32
+    FLUSH_INTERVAL = 0.05
+    # Batches are also cut before their encoded results pass this many
+    # bytes, well under RabbitMQ's 16 MiB default max_message_size
+    RESULT_BATCH_BYTES = 4 << 20
+    # Number of recent task IDs remembered for deduplication
+    MAX_TRACKED_TASKS = 100
+    # Number of recent results kept by content hash for re-uploaded CSVs;
+    # parsed rows take several times their CSV size in memory, so the
+    # cache is also bounded by CSV bytes and skips large uploads
+    RESULT_CACHE_SIZE = 128
+    RESULT_CACHE_BYTES = 16 << 20
+    MAX_CACHED_CSV_BYTES = 1 << 20
+    # Broker heartbeat timeout, and the longest the consume loop waits for
+    # I/O before checking for a stop request; both in seconds
+    HEARTBEAT = 30
+    POLL_INTERVAL = 1
+    
+    def __init__(self, worker_id, host='localhost', connection=None):
         self.worker_id = worker_id
-        self.connection = pika.BlockingConnection(pika.ConnectionParameters(host=host))
+        # An existing connection can be passed in to share it (e.g. in tests)
+        params = pika.ConnectionParameters(host=host, heartbeat=self.HEARTBEAT)
+        self.connection = connection or pika.BlockingConnection(params)
         self.channel = self.connection.channel()
         
-        # Declare queues
-        self.channel.queue_declare(queue='csv_tasks')
-        self.channel.queue_declare(queue='processed_results')
+        # Results go out on their own connection, so broker flow control
+        # on the publishing side doesn't stall task delivery (and the
+        # reverse); a shared connection is reused for both
+        self._pub_conn = connection or pika.BlockingConnection(params)
+        self._pub_chan = self._pub_conn.channel()
+        
+        # The master declares both queues at startup, so only check they
+        # exist; a worker booted before any master declares them itself
+        self.channel = self._check_queue(self.connection, self.channel, 'csv_tasks')
+        self._pub_chan = self._check_queue(self._pub_conn, self._pub_chan, 'processed_results')
         
-        # Set prefetch count to limit concurrent tasks
-        self.channel.basic_qos(prefetch_count=1)
+        # Let the broker keep a window of tasks in flight so results can be
+        # published and acknowledged in batches
+        self.channel.basic_qos(prefetch_count=self.PREFETCH_COUNT)
+        # (delivery_tag, task_id, result body or None) awaiting publish/ack
+        self._pending = []
+        self._pending_bytes = 0  # Encoded size of the pending results
+        # Delivery tags of tasks still running on the thread pool
+        self._in_flight = set()
+        
+        # CSV work runs on the pool; this thread only dispatches tasks and
+        # performs every channel operation, as pika requires
+        self._pool = ThreadPoolExecutor(max_workers=self.MAX_THREADS)
+        # Finished tasks handed back from the pool, drained on this thread
+        self._completed = queue.Queue()
+        self._wakeup_scheduled = threading.Event()
         
         # Set up consumer with manual acknowledgment
         self.channel.basic_consume(
@@ -26,73 +82,207 @@ class Worker:
             auto_ack=False
         )
         
-        # Track processed tasks to avoid duplicates
-        self.processed_tasks = set()
+        # Track processed tasks to avoid duplicates, least recently seen first
+        self.processed_tasks = OrderedDict()
+        # content_hash -> (CSV bytes, process_csv result), least recently
+        # used first; shared by the pool threads
+        self._result_cache = OrderedDict()
+        self._result_cache_bytes = 0  # Total CSV bytes of cached entries
+        self._result_cache_lock = threading.Lock()
+        
+        # Set by stop() to end the consume loop in start()
+        self._stop = False
         
+    @staticmethod
+    def _check_queue(connection, channel, queue_name):
+        """Verify a queue exists, declaring it if missing; return a usable channel"""
+        try:
+            channel.queue_declare(queue=queue_name, passive=True)
+        except pika.exceptions.ChannelClosedByBroker:
+            # A failed passive declare closes the channel, so declare the
+            # queue on a fresh one
+            channel = connection.channel()
+            channel.queue_declare(queue=queue_name)
+        return channel
+    
     def process_task(self, ch, method, properties, body):
-        """Process CSV task and publish result"""
+        """Hand a CSV task to the thread pool"""
+        # The body is the raw CSV, parsed without any decoding; the
+        # task ID is the message ID, with a header copy as fallback
+        task_id = properties.message_id or (properties.headers or {}).get('task_id')
+        
+        # Check for duplicates; they are acknowledged with the next batch
+        if task_id in self.processed_tasks:
+            self.processed_tasks.move_to_end(task_id)
+            print(f"Worker {self.worker_id}: Skipping duplicate task {task_id}")
+            self._add_pending(method.delivery_tag, task_id, None)
+            return
+        
+        # Recorded at dispatch, so a copy delivered while this one is
+        # still running is skipped too; evict the least recently seen
+        self.processed_tasks[task_id] = None
+        if len(self.processed_tasks) > self.MAX_TRACKED_TASKS:
+            self.processed_tasks.popitem(last=False)
+        
+        print(f"Worker {self.worker_id}: Processing task {task_id}")
+        self._in_flight.add(method.delivery_tag)
+        self._pool.submit(self._run_task, method.delivery_tag, task_id, body)
+    
+    def _run_task(self, delivery_tag, task_id, csv_data):
+        """Process CSV data on a pool thread"""
         try:
-            # Parse message
-            message = json.loads(body)
-            task_id = message.get('task_id')
-            csv_data = message.get('csv_data')
-            
-            # Check for duplicates
-            if task_id in self.processed_tasks:
-                print(f"Worker {self.worker_id}: Skipping duplicate task {task_id}")
-                ch.basic_ack(delivery_tag=method.delivery_tag)
-                return
-            
-            print(f"Worker {self.worker_id}: Processing task {task_id}")
-            
-            # Simulate processing time
-            processing_time = random.uniform(0.5, 2.0)
-            time.sleep(processing_time)
-            
-            # Process CSV data
-            result = process_csv(csv_data, task_id)
+            # Process CSV data, timing only the actual work; content seen
+            # recently under another task ID reuses the earlier result
+            start_time = time.perf_counter()
+            digest = content_hash(csv_data)
+            cached = self._cached_result(digest, csv_data)
+            if cached is None:
+                result = process_csv(csv_data, task_id)
+                self._cache_result(digest, csv_data, result)
+                result = dict(result)
+            else:
+                # Reused rows, but this upload's own envelope
+                result = dict(cached, task_id=task_id)
+                if 'processed_at' in result:
+                    result['processed_at'] = datetime.now().isoformat()
+            processing_time = time.perf_counter() - start_time
             result['worker_id'] = self.worker_id
+            result['content_hash'] = digest
             result['processing_time'] = processing_time
-            
-            # Add to processed tasks
-            self.processed_tasks.add(task_id)
-            # Limit size of set
-            if len(self.processed_tasks) > 100:
-                self.processed_tasks.pop()
-            
-            # Publish result
-            self.channel.basic_publish(
+            body = json.dumps(result)
+            if isinstance(body, str):
+                body = body.encode()  # stdlib json fallback
+        except Exception as e:
+            print(f"Worker {self.worker_id}: Error processing task: {e}")
+            body = None
+        
+        # Channel operations must happen on the connection's thread; one
+        # wakeup drains everything that finished before it runs
+        self._completed.put((delivery_tag, task_id, body))
+        if not self._wakeup_scheduled.is_set():
+            self._wakeup_scheduled.set()
+            self.connection.add_callback_threadsafe(self._drain_completed)
+    
+    def _cached_result(self, digest, csv_data):
+        """Return the cached result for this CSV content, or None"""
+        with self._result_cache_lock:
+            entry = self._result_cache.get(digest)
+            # The digest can collide, even deliberately, so a hit also
+            # needs the same bytes before another upload's rows are reused
+            if entry is None or entry[0] != csv_data:
+                return None
+            self._result_cache.move_to_end(digest)
+            return entry[1]
+    
+    def _cache_result(self, digest, csv_data, result):
+        """Remember a result, evicting the least recently used"""
+        if len(csv_data) > self.MAX_CACHED_CSV_BYTES:
+            return
+        with self._result_cache_lock:
+            previous = self._result_cache.pop(digest, None)
+            if previous is not None:
+                self._result_cache_bytes -= len(previous[0])
+            self._result_cache[digest] = (csv_data, result)
+            self._result_cache_bytes += len(csv_data)
+            while (len(self._result_cache) > self.RESULT_CACHE_SIZE
+                   or self._result_cache_bytes > self.RESULT_CACHE_BYTES):
+                evicted, _ = self._result_cache.popitem(last=False)[1]
+                self._result_cache_bytes -= len(evicted)
+    
+    def _drain_completed(self):
+        """Settle every task the pool has finished so far"""
+        # Cleared before draining, so a task queued after the final get
+        # schedules a fresh wakeup
+        self._wakeup_scheduled.clear()
+        while True:
+            try:
+                delivery_tag, task_id, body = self._completed.get_nowait()
+            except queue.Empty:
+                return
+            self._finish_task(delivery_tag, task_id, body)
+    
+    def _finish_task(self, delivery_tag, task_id, body):
+        """Record a task the pool has finished with"""
+        self._in_flight.discard(delivery_tag)
+        if body is None:
+            # Forget the task so its redelivery is processed, then
+            # negative acknowledgment with requeue
+            self.processed_tasks.pop(task_id, None)
+            self.channel.basic_nack(delivery_tag=delivery_tag, requeue=True)
+            return
+        
+        # Queue result for the next batched publish
+        self._add_pending(delivery_tag, task_id, body)
+    
+    def _add_pending(self, delivery_tag, task_id, body):
+        """Buffer a finished task until the next flush"""
+        size = len(body) if body is not None else 0
+        # Send what is pending first if this result would push the batch
+        # over the size limit; a single larger result still goes alone
+        if self._pending and self._pending_bytes + size > self.RESULT_BATCH_BYTES:
+            self._flush_results()
+        self._pending.append((delivery_tag, task_id, body))
+        self._pending_bytes += size
+        if len(self._pending) >= self.RESULT_BATCH_SIZE:
+            self._flush_results()
+        elif len(self._pending) == 1:
+            self.connection.call_later(self.FLUSH_INTERVAL, self._flush_results)
+    
+    def _flush_results(self):
+        """Publish buffered results in one message, then acknowledge their tasks"""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        self._pending_bytes = 0
+        
+        # Results are already encoded, so the batch body is spliced
+        # together from them rather than serialized again
+        bodies = [body for _, _, body in pending if body is not None]
+        if bodies:
+            self._pub_chan.basic_publish(
                 exchange='',
                 routing_key='processed_results',
-                body=json.dumps(result),
+                body=b'{"results":[' + b','.join(bodies) + b']}',
                 properties=pika.BasicProperties(
                     delivery_mode=2,  # Make message persistent
-                    message_id=task_id  # For deduplication
+                    content_type='application/json'
                 )
             )
-            
-            # Acknowledge message
-            ch.basic_ack(delivery_tag=method.delivery_tag)
-            
-            print(f"Worker {self.worker_id}: Completed task {task_id}")
-            
-        except Exception as e:
-            print(f"Worker {self.worker_id}: Error processing task: {e}")
-            # Negative acknowledgment with requeue
-            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+            for _, task_id, body in pending:
+                if body is not None:
+                    print(f"Worker {self.worker_id}: Completed task {task_id}")
+        
+        # Tasks finish out of order, and a multiple ack would also cover
+        # tasks still running; so it only reaches below the oldest running
+        # task and anything newer is acknowledged individually
+        tags = sorted(delivery_tag for delivery_tag, _, _ in pending)
+        oldest_running = min(self._in_flight, default=None)
+        covered = [tag for tag in tags if oldest_running is None or tag < oldest_running]
+        if covered:
+            self.channel.basic_ack(delivery_tag=covered[-1], multiple=True)
+        for tag in tags[len(covered):]:
+            self.channel.basic_ack(delivery_tag=tag)
     
     def start(self):
         """Start the worker"""
         print(f"Worker {self.worker_id} started. Waiting for CSV tasks...")
-        self.channel.start_consuming()
+        # Waits are bounded so heartbeats on both connections are serviced
+        # at least every POLL_INTERVAL; the publishing connection is only
+        # driven here and when publishing, so it would otherwise miss them
+        while not self._stop:
+            self.connection.process_data_events(time_limit=self.POLL_INTERVAL)
+            if self._pub_conn is not self.connection:
+                self._pub_conn.process_data_events(time_limit=0)
+        self._flush_results()
+    
+    def stop(self):
+        """Ask the consume loop to exit after its current wait"""
+        self._stop = True
 
 if __name__ == '__main__':
     # Use command line arg as worker ID or generate a random one
     worker_id = sys.argv[1] if len(sys.argv) > 1 else f"worker-{random.randint(1000, 9999)}"
     
-    # Add random delay to reduce chance of multiple workers starting simultaneously
-    time.sleep(random.uniform(0.1, 0.5))
-    
     worker = Worker(worker_id)
     
     try: